@@ -2,10 +2,16 @@
 
 import asyncio
 import logging
+import re
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
 from aiogram.types import Message
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 from config import Config
 from deepseek import DeepSeekAPI
@@ -24,46 +30,92 @@ dp = Dispatcher()
 
 # Инициализация клиента DeepSeek и хранилища истории
 deepseek_client = DeepSeekAPI(api_key=Config.DEEPSEEK_API_KEY)
+
+# Выделенные потоки для запросов к DeepSeek: запросы одного пользователя идут
+# последовательно, поэтому достаточно одного потока на пользователя
+deepseek_executor = ThreadPoolExecutor(
+    max_workers=len(Config.ALLOWED_USER_IDS), thread_name_prefix="deepseek"
+)
 message_history = MessageHistory(max_messages=Config.MAX_HISTORY_MESSAGES)
 
-# Буферы сообщений для каждого пользователя (ожидают обработки)
-message_buffers: dict[int, str] = {}
+# Системное сообщение собирается один раз; пустой prompt не отправляется
+SYSTEM_MSG: list[dict[str, str]] = (
+    [{"role": "system", "content": Config.SYSTEM_PROMPT}]
+    if Config.SYSTEM_PROMPT
+    else []
+)
+
+# Максимальное количество запросов к DeepSeek на одну обработку буфера
+MAX_COMPLETION_ROUNDS = 3
+
+# Слово для расчета времени "набора" ответа
+_WORD_RE = re.compile(r"\S+")
+
 
-# Последние объекты сообщений для каждого пользователя (для ответа)
-last_messages: dict[int, Message] = {}
+def _set_event() -> asyncio.Event:
+    """Создать событие в установленном состоянии."""
+    event = asyncio.Event()
+    event.set()
+    return event
 
-# Активные задачи таймеров для каждого пользователя
-timer_tasks: dict[int, asyncio.Task] = {}
 
-answering_to: dict[int, bool] = {}
+@dataclass
+class UserState:
+    """Состояние диалога с пользователем."""
+
+    # Буфер сообщений, ожидающих обработки
+    buffer: list[str] = field(default_factory=list)
+    # Последний объект сообщения (для ответа)
+    last_message: Message | None = None
+    # Активная задача таймера
+    timer: asyncio.Task | None = None
+    # Установлено, когда бот не обрабатывает сообщения пользователя
+    # (сброшено от запроса к DeepSeek до окончания отправки ответа)
+    done: asyncio.Event = field(default_factory=_set_event)
+    # Задача отправки последнего ответа
+    answer_task: asyncio.Task | None = None
+    # Поколение таймера, увеличивается с каждым новым сообщением
+    gen: int = 0
+
+    @property
+    def answering(self) -> bool:
+        """Бот обрабатывает сообщения пользователя или отправляет ответ."""
+        return not self.done.is_set()
+
+
+# Состояние для каждого пользователя
+users: dict[int, UserState] = {}
 
 
 async def answer_message(message_obj: Message, response: str):
-    answering_to[message_obj.from_user.id] = True
+    st = users[message_obj.from_user.id]
+    st.done.clear()
     try:
-        paragraphs = response.split("\n\n")
-        for paragraph in paragraphs:
-            words = paragraph.split()
-            time_to_wait = len(words) / Config.WORDS_PER_MINUTE * 60
+        for paragraph in response.split("\n\n"):
+            word_count = sum(1 for _ in _WORD_RE.finditer(paragraph))
+            time_to_wait = word_count / Config.WORDS_PER_MINUTE * 60
             await asyncio.sleep(time_to_wait)
             await message_obj.answer(
                 paragraph.rstrip().rstrip("."), parse_mode="Markdown"
             )
     finally:
-        answering_to[message_obj.from_user.id] = False
+        st.done.set()
 
 
-async def wait_for_answer_completion(user_id: int, check_interval: float = 0.5) -> None:
-    """
-    Ждет, пока бот не закончит отвечать пользователю.
+async def request_completion(prompt: list[dict[str, str]]) -> str:
+    """Запрашивает ответ DeepSeek в выделенном потоке."""
+    return await asyncio.get_running_loop().run_in_executor(
+        deepseek_executor, deepseek_client.chat_completion, prompt
+    )
 
-    Args:
-        user_id: ID пользователя
-        check_interval: Интервал проверки в секундах
-    """
-    while answering_to.get(user_id, False):
-        await asyncio.sleep(check_interval)
-        logger.debug(f"Ожидание завершения ответа для пользователя {user_id}")
+
+def _log_answer_error(task: asyncio.Task) -> None:
+    """Логирует ошибку фоновой отправки ответа."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(
+            f"Ошибка при отправке ответа: {task.exception()}",
+            exc_info=task.exception(),
+        )
 
 
 async def process_buffered_message(user_id: int, message_obj: Message):
@@ -74,47 +126,73 @@ async def process_buffered_message(user_id: int, message_obj: Message):
         user_id: ID пользователя
         message_obj: Объект последнего сообщения (для ответа)
     """
-    if user_id not in message_buffers:
+    st = users.get(user_id)
+    if st is None or not st.buffer:
         return
 
     # Ждем, пока бот не закончит отвечать этому пользователю
-    if answering_to.get(user_id, False):
+    while st.answering:
         logger.info(
-            f"Бот уже отвечает пользователю {user_id}, ожидание завершения ответа..."
+            "Бот уже отвечает пользователю %s, ожидание завершения ответа...", user_id
         )
-        await wait_for_answer_completion(user_id)
+        await st.done.wait()
 
     # Проверяем еще раз после ожидания (на случай, если пришли новые сообщения)
-    if user_id not in message_buffers:
-        logger.debug(f"Буфер для пользователя {user_id} был очищен во время ожидания")
+    if not st.buffer:
+        logger.debug("Буфер для пользователя %s был очищен во время ожидания", user_id)
         return
 
     # Получаем накопленное сообщение
-    merged_text = message_buffers[user_id]
-    del message_buffers[user_id]
+    merged_text = "\n\n".join(st.buffer)
+    st.buffer.clear()
 
     logger.info(
-        f"Обработка накопленного сообщения от пользователя {user_id}: {merged_text}"
+        "Обработка накопленного сообщения от пользователя %s: %s", user_id, merged_text
     )
 
+    # Следующая обработка этого пользователя дождется отправки ответа
+    st.done.clear()
+    answer_started = False
     try:
-        message_history.add_message(user_id, "user", merged_text)
+        history = await message_history.add_message(user_id, "user", merged_text)
+        prompt = [*SYSTEM_MSG, *history]
+
+        response = await request_completion(prompt)
+
+        # Если пока ждали DeepSeek пришли новые сообщения, добавляем их
+        # к тому же запросу вместо отдельного ответа на каждую пачку
+        rounds = 1
+        while st.buffer and rounds < MAX_COMPLETION_ROUNDS:
+            merged_text = "\n\n".join(st.buffer)
+            st.buffer.clear()
+            rounds += 1
+            logger.info(
+                "Новые сообщения от пользователя %s добавлены к запросу: %s",
+                user_id,
+                merged_text,
+            )
 
-        prompt = [
-            {"role": "system", "content": Config.SYSTEM_PROMPT or ""},
-            *message_history.get_history(user_id),
-        ]
+            await message_history.add_message(user_id, "user", merged_text)
+            prompt.append({"role": "user", "content": merged_text})
+            if st.last_message is not None:
+                message_obj = st.last_message
 
-        response = await asyncio.to_thread(deepseek_client.chat_completion, prompt)
+            response = await request_completion(prompt)
 
-        logger.info(f"Ответ DeepSeek для пользователя {user_id}: {response}")
+        logger.info("Ответ DeepSeek для пользователя %s: %s", user_id, response)
 
-        message_history.add_message(user_id, "assistant", response)
+        await message_history.add_message(user_id, "assistant", response)
 
-        await answer_message(message_obj, response)
+        # Ответ отправляется в фоне, по завершении он установит st.done
+        st.answer_task = asyncio.create_task(answer_message(message_obj, response))
+        st.answer_task.add_done_callback(_log_answer_error)
+        answer_started = True
 
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}", exc_info=True)
+    finally:
+        if not answer_started:
+            st.done.set()
 
 
 async def handle_user_message(message: Message, user_id: int, text: str):
@@ -129,91 +207,82 @@ async def handle_user_message(message: Message, user_id: int, text: str):
         user_id: ID пользователя
         text: Текст сообщения
     """
-    # Проверяем, разрешен ли пользователь
-    if user_id not in Config.ALLOWED_USER_IDS:
-        logger.info(f"Сообщение от неразрешенного пользователя {user_id}")
-        return
+    st = users.setdefault(user_id, UserState())
 
     # Если есть активный таймер, отменяем его
-    if user_id in timer_tasks:
-        timer_tasks[user_id].cancel()
-        del timer_tasks[user_id]
-        logger.debug(f"Отменен таймер для пользователя {user_id}")
+    if st.timer is not None:
+        st.timer.cancel()
+        st.timer = None
+        logger.debug("Отменен таймер для пользователя %s", user_id)
 
     # Мерджим новое сообщение с существующим буфером
-    if user_id in message_buffers:
-        message_buffers[user_id] = f"{message_buffers[user_id]}\n\n{text}"
-        logger.debug(f"Сообщение добавлено в буфер для пользователя {user_id}")
+    if st.buffer:
+        logger.debug("Сообщение добавлено в буфер для пользователя %s", user_id)
     else:
-        message_buffers[user_id] = text
-        logger.debug(f"Создан новый буфер для пользователя {user_id}")
+        logger.debug("Создан новый буфер для пользователя %s", user_id)
+    st.buffer.append(text)
 
     # Сохраняем ссылку на последнее сообщение для ответа
-    last_messages[user_id] = message
+    st.last_message = message
+
+    # Новое поколение таймера: все предыдущие таймеры становятся неактуальными
+    st.gen += 1
+    my_gen = st.gen
 
     # Создаем новую задачу таймера
     async def timer_task():
-        # Сохраняем ссылку на текущую задачу для проверки актуальности
-        current_task = asyncio.current_task()
         try:
             await asyncio.sleep(Config.MESSAGE_WAIT_SECONDS)
             # Проверяем, что таймер все еще активен (не был заменен новым)
-            if user_id not in timer_tasks or timer_tasks[user_id] != current_task:
+            if st.gen != my_gen:
                 logger.debug(
-                    f"Таймер для пользователя {user_id} был заменен новым, прерываем обработку"
+                    "Таймер для пользователя %s был заменен новым, прерываем обработку",
+                    user_id,
                 )
                 return
 
-            # Если таймер не был отменен, проверяем возможность обработки
-            if user_id in message_buffers and user_id in last_messages:
-                # Если бот уже отвечает, ждем завершения ответа
-                if answering_to.get(user_id, False):
+            if not st.buffer or st.last_message is None:
+                return
+
+            # Если бот уже отвечает, ждем завершения ответа
+            if st.answering:
+                logger.debug(
+                    "Таймер истек для пользователя %s, но бот уже отвечает. Ожидание...",
+                    user_id,
+                )
+                await st.done.wait()
+
+                if st.gen != my_gen:
                     logger.debug(
-                        f"Таймер истек для пользователя {user_id}, но бот уже отвечает. Ожидание..."
+                        "Таймер для пользователя %s был заменен во время ожидания",
+                        user_id,
                     )
-                    await wait_for_answer_completion(user_id)
-
-                    # Проверяем, что таймер все еще актуален после ожидания
-                    if (
-                        user_id not in timer_tasks
-                        or timer_tasks[user_id] != current_task
-                    ):
-                        logger.debug(
-                            f"Таймер для пользователя {user_id} был заменен во время ожидания"
-                        )
-                        return
-
-                    # Проверяем еще раз после ожидания
-                    if user_id not in message_buffers or user_id not in last_messages:
-                        logger.debug(
-                            f"Буфер или сообщение для пользователя {user_id} были удалены во время ожидания"
-                        )
-                        return
-
-                # Обрабатываем сообщение только если бот не отвечает и таймер все еще актуален
-                if not answering_to.get(user_id, False):
-                    # Еще раз проверяем актуальность таймера перед обработкой
-                    if user_id in timer_tasks and timer_tasks[user_id] == current_task:
-                        await process_buffered_message(user_id, last_messages[user_id])
-                        # Очищаем таймер только если он все еще актуален
-                        if (
-                            user_id in timer_tasks
-                            and timer_tasks[user_id] == current_task
-                        ):
-                            del timer_tasks[user_id]
-                        if user_id in last_messages:
-                            del last_messages[user_id]
-                else:
+                    return
+
+                if not st.buffer or st.last_message is None:
                     logger.debug(
-                        f"Бот все еще отвечает пользователю {user_id}, обработка отложена"
+                        "Буфер или сообщение для пользователя %s были удалены во время ожидания",
+                        user_id,
                     )
+                    return
+
+            # Начатую обработку новые сообщения не отменяют: их
+            # подхватит process_buffered_message или следующий таймер
+            st.timer = None
+            await process_buffered_message(user_id, st.last_message)
+
+            # Очищаем сообщение, если за время обработки не пришли новые
+            if st.gen == my_gen:
+                st.last_message = None
         except asyncio.CancelledError:
             # Таймер был отменен, это нормально
             pass
 
-    timer_tasks[user_id] = asyncio.create_task(timer_task())
+    st.timer = asyncio.create_task(timer_task())
     logger.debug(
-        f"Создан таймер на {Config.MESSAGE_WAIT_SECONDS} секунд для пользователя {user_id}"
+        "Создан таймер на %s секунд для пользователя %s",
+        Config.MESSAGE_WAIT_SECONDS,
+        user_id,
     )
 
 
@@ -225,24 +294,61 @@ async def cmd_start(message: Message):
     )
 
 
-@dp.business_message()
+# Фильтры отсекают медиа и неразрешенных пользователей до вызова обработчика
+@dp.business_message(F.text, F.from_user.id.in_(Config.ALLOWED_USER_IDS))
 async def handle_business_message(business_message: Message):
     """
     Обработчик текстовых сообщений из бизнес-аккаунта.
 
     Отвечает только разрешенным пользователям и игнорирует медиа.
     """
-    # Обрабатываем только текстовые сообщения
-    if not business_message.text:
-        return
-
     user_id = business_message.from_user.id
     text = business_message.text
 
-    logger.info(f"Получено бизнес-сообщение от пользователя {user_id}: {text}")
+    logger.info("Получено бизнес-сообщение от пользователя %s: %s", user_id, text)
     await handle_user_message(business_message, user_id, text)
 
 
+async def run_webhook():
+    """Запускает сервер для приема обновлений от Telegram через webhook."""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=Config.WEBHOOK_SECRET
+    ).register(app, path=Config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    await bot.set_webhook(
+        Config.WEBHOOK_URL,
+        secret_token=Config.WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, port=Config.WEBHOOK_PORT)
+    await site.start()
+    logger.info(
+        f"Webhook-сервер запущен на порту {Config.WEBHOOK_PORT}, "
+        f"путь {Config.WEBHOOK_PATH}"
+    )
+
+    # В отличие от start_polling, сервер сам не обрабатывает сигналы:
+    # без этого docker stop завершил бы процесс без записи истории
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        # Обновления обрабатываются сервером, просто ждем сигнала остановки
+        await stop.wait()
+        logger.info("Получен сигнал остановки, завершение webhook-сервера...")
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        await runner.cleanup()
+
+
 async def main():
     """Главная функция для запуска бота."""
     logger.info("Запуск бота...")
@@ -253,8 +359,21 @@ async def main():
     logger.info(f"Время ожидания перед ответом: {Config.MESSAGE_WAIT_SECONDS} секунд")
     logger.info(f"System prompt: {Config.SYSTEM_PROMPT or 'Не установлен'}")
 
+    # Фоновая запись истории на диск
+    flusher = asyncio.create_task(message_history.run_flusher())
+
     # Запускаем бота
-    await dp.start_polling(bot)
+    try:
+        if Config.WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+        # Дописываем сообщения, накопленные за последний интервал
+        await message_history.flush()
 
 
 if __name__ == "__main__":
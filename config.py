@@ -22,12 +22,10 @@ class Config:
         raise ValueError("DEEPSEEK_API_KEY не установлен в переменных окружения")
 
     # Разрешенные пользователи (список ID через запятую)
-    ALLOWED_USER_IDS: list[int] = []
     _allowed_users_str = os.getenv("ALLOWED_USER_IDS", "")
-    if _allowed_users_str:
-        ALLOWED_USER_IDS = [
-            int(uid.strip()) for uid in _allowed_users_str.split(",") if uid.strip()
-        ]
+    ALLOWED_USER_IDS: frozenset[int] = frozenset(
+        int(uid.strip()) for uid in _allowed_users_str.split(",") if uid.strip()
+    )
     if not ALLOWED_USER_IDS:
         raise ValueError("ALLOWED_USER_IDS не установлен в переменных окружения")
 
@@ -47,3 +45,11 @@ class Config:
     WORDS_PER_MINUTE: int = int(os.getenv("WORDS_PER_MINUTE", "100"))
     if WORDS_PER_MINUTE <= 0:
         WORDS_PER_MINUTE = 100
+
+    # Публичный URL для webhook (если не указан, используется polling)
+    WEBHOOK_URL: Optional[str] = os.getenv("WEBHOOK_URL") or None
+
+    # Путь, порт и секретный токен локального webhook-сервера
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", "8080"))
+    WEBHOOK_SECRET: Optional[str] = os.getenv("WEBHOOK_SECRET") or None
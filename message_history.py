@@ -1,108 +1,287 @@
 """Хранение истории сообщений в памяти с персистентностью."""
 
+import asyncio
+import atexit
 import json
 import logging
+import sqlite3
+from collections import OrderedDict, deque
 from pathlib import Path
-from typing import Dict, List
+from typing import Deque, Dict, List, Sequence, Tuple
 
 logger = logging.getLogger(__name__)
 
 data_path = Path("data")
 data_path.mkdir(exist_ok=True)
 
+# Файлы, в которых история хранилась до перехода на SQLite
+_LEGACY_FILES = ("message_history.json", "message_history.jsonl")
+
 
 class MessageHistory:
-    """Класс для хранения истории сообщений в памяти с сохранением в JSON."""
+    """Класс для хранения истории сообщений в памяти с сохранением в SQLite."""
 
     def __init__(
-        self, max_messages: int = 50, storage_path: str = "message_history.json"
+        self,
+        max_messages: int = 50,
+        storage_path: str = "history.db",
+        flush_interval: float = 2.0,
+        max_users: int = 10000,
     ):
         """
         Инициализация хранилища истории.
 
         Args:
             max_messages: Максимальное количество сообщений для хранения на пользователя
-            storage_path: Путь к файлу для сохранения истории
+            storage_path: Путь к файлу базы данных истории
+            flush_interval: Задержка перед записью накопленных сообщений (в секундах)
+            max_users: Максимальное количество пользователей в памяти,
+                давно неактивные подгружаются из базы при обращении
         """
         self.max_messages = max_messages
         self.storage_path = data_path / storage_path
-        self._history: Dict[int, List[Dict[str, str]]] = {}
+        self.flush_interval = flush_interval
+        self.max_users = max_users
+        # Порядок ключей - от давно неактивных к недавним
+        self._history: OrderedDict[int, Deque[Dict[str, str]]] = OrderedDict()
+        self._pending: List[Tuple[int, str, str]] = []
+        self._flush_lock = asyncio.Lock()
+        self._dirty = asyncio.Event()
+
+        self._conn = sqlite3.connect(self.storage_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY, "
+            "user_id INTEGER NOT NULL, "
+            "role TEXT NOT NULL, "
+            "content TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS messages_user_id ON messages (user_id, id)"
+        )
+        self._conn.commit()
+
+        self._import_legacy_files()
+        atexit.register(self.close)
+
+    def _import_legacy_files(self) -> None:
+        """Перенести историю из JSON файлов прежних версий в базу."""
+        for name in _LEGACY_FILES:
+            path = data_path / name
+            if not path.exists():
+                continue
+
+            records: List[Tuple[int, str, str]] = []
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    if path.suffix == ".json":
+                        for user_id, messages in json.load(f).items():
+                            records.extend(
+                                (int(user_id), m["role"], m["content"])
+                                for m in messages
+                            )
+                    else:
+                        for line in f:
+                            if line.strip():
+                                record = json.loads(line)
+                                records.append((record["u"], record["r"], record["c"]))
+            except (json.JSONDecodeError, KeyError, ValueError, IOError) as e:
+                logger.warning(f"Ошибка при загрузке истории из файла {path}: {e}")
+                continue
+
+            # Файл переименовывается только после успешной записи, иначе
+            # импорт повторится при следующем запуске
+            if not self._write_records(records):
+                continue
+            path.rename(path.with_name(path.name + ".imported"))
+            logger.info(f"История из файла {path} перенесена в {self.storage_path}")
+
+    def _select_user(self, user_id: int) -> List[Tuple[str, str]]:
+        """Прочитать последние сообщения пользователя из базы."""
+        return self._conn.execute(
+            "SELECT role, content FROM messages WHERE user_id = ? "
+            "ORDER BY id DESC LIMIT ?",
+            (user_id, self.max_messages),
+        ).fetchall()
+
+    def _delete_user(self, user_id: int) -> None:
+        """Удалить сообщения пользователя из базы."""
+        with self._conn:
+            self._conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+
+    async def _load_user(self, user_id: int) -> Deque[Dict[str, str]]:
+        """Загрузить историю пользователя из базы, не помещая ее в память."""
+        # Соединение с базой используется только под _flush_lock
+        async with self._flush_lock:
+            rows = await asyncio.to_thread(self._select_user, user_id)
 
-        # Загружаем историю из файла при инициализации
-        self._load_from_file()
+        messages: Deque[Dict[str, str]] = deque(maxlen=self.max_messages)
+        for role, content in reversed(rows):
+            messages.append({"role": role, "content": content})
+        # Сообщения, которые еще не записаны в базу
+        for pending_user_id, role, content in self._pending:
+            if pending_user_id == user_id:
+                messages.append({"role": role, "content": content})
+        return messages
 
-    def _load_from_file(self) -> None:
-        """Загрузить историю сообщений из JSON файла."""
-        if not self.storage_path.exists():
-            return
+    def _remember(
+        self, user_id: int, messages: Deque[Dict[str, str]]
+    ) -> Deque[Dict[str, str]]:
+        """Поместить загруженную историю в память, вытеснив давно неактивных."""
+        # Пока шло чтение, историю мог загрузить параллельный вызов
+        if user_id in self._history:
+            self._history.move_to_end(user_id)
+            return self._history[user_id]
+
+        self._history[user_id] = messages
+        while len(self._history) > self.max_users:
+            self._history.popitem(last=False)
+        return messages
+
+    async def _get_cached(self, user_id: int) -> Deque[Dict[str, str]]:
+        """Получить историю пользователя из памяти, при промахе - из базы."""
+        if user_id in self._history:
+            self._history.move_to_end(user_id)
+            return self._history[user_id]
+
+        return self._remember(user_id, await self._load_user(user_id))
 
+    def _write_records(self, records: List[Tuple[int, str, str]]) -> bool:
+        """
+        Записать сообщения в базу и удалить вышедшие за лимит.
+
+        Returns:
+            True, если транзакция закоммичена, False при ошибке (изменения откатываются)
+        """
         try:
-            with open(self.storage_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                # Конвертируем ключи из строк обратно в int
-                self._history = {
-                    int(user_id): messages for user_id, messages in data.items()
-                }
-        except (json.JSONDecodeError, ValueError, IOError) as e:
-            # Если файл поврежден или не может быть прочитан, начинаем с пустой истории
-            logger.warning(
-                f"Ошибка при загрузке истории из файла {self.storage_path}: {e}"
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+                    records,
+                )
+                self._conn.executemany(
+                    "DELETE FROM messages WHERE user_id = ? AND id <= ("
+                    "SELECT id FROM messages WHERE user_id = ? "
+                    "ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    [
+                        (user_id, user_id, self.max_messages)
+                        for user_id in {record[0] for record in records}
+                    ],
+                )
+        except sqlite3.Error as e:
+            logger.error(
+                f"Ошибка при сохранении истории в базу {self.storage_path}: {e}"
             )
+            return False
+        return True
 
-    def _save_to_file(self) -> None:
-        """Сохранить историю сообщений в JSON файл."""
-        try:
-            # Создаем директорию, если её нет
-            self.storage_path.parent.mkdir(parents=True, exist_ok=True)
+    async def flush(self) -> None:
+        """Записать накопленные сообщения в базу, не блокируя event loop."""
+        async with self._flush_lock:
+            records = self._pending[:]
+            if not records:
+                return
 
-            with open(self.storage_path, "w", encoding="utf-8") as f:
-                json.dump(self._history, f, ensure_ascii=False, indent=2)
-        except IOError as e:
-            logger.error(
-                f"Ошибка при сохранении истории в файл {self.storage_path}: {e}"
+            # Future пула потоков, а не задача: при завершении event loop
+            # asyncio.run отменяет все задачи, но не такие futures
+            write = asyncio.get_running_loop().run_in_executor(
+                None, self._write_records, records
             )
+            try:
+                await asyncio.shield(write)
+            finally:
+                # Поток закоммитит записи даже при отмене flush(): дожидаемся
+                # его, иначе close() вставит те же записи повторно
+                while not write.done():
+                    try:
+                        await asyncio.shield(write)
+                    except asyncio.CancelledError:
+                        pass
+
+                # Записи убираются из очереди только после коммита, чтобы
+                # загрузка истории из базы не пропустила их. При ошибке они
+                # останутся в очереди и будут записаны следующим flush()
+                if write.result():
+                    del self._pending[: len(records)]
+
+    async def run_flusher(self) -> None:
+        """
+        Фоновая задача записи истории.
+
+        Ждет появления новых сообщений и записывает их пачкой через
+        flush_interval секунд, так что вопрос и ответ обычно попадают
+        в базу одной транзакцией.
+        """
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(self.flush_interval)
+            self._dirty.clear()
+            await self.flush()
+
+    def close(self) -> None:
+        """Дописать оставшиеся сообщения и закрыть базу."""
+        if self._pending and self._write_records(self._pending):
+            self._pending = []
+        self._conn.close()
 
-    def add_message(self, user_id: int, role: str, content: str) -> None:
+    async def add_message(
+        self, user_id: int, role: str, content: str
+    ) -> Sequence[Dict[str, str]]:
         """
         Добавить сообщение в историю пользователя.
 
+        Сообщение сразу доступно в памяти, в базу его запишет run_flusher().
+
         Args:
             user_id: ID пользователя
             role: Роль сообщения ('user' или 'assistant')
             content: Содержимое сообщения
-        """
-        if user_id not in self._history:
-            self._history[user_id] = []
 
-        self._history[user_id].append({"role": role, "content": content})
+        Returns:
+            История пользователя с добавленным сообщением (как в get_history)
+        """
+        history = await self._get_cached(user_id)
+        history.append({"role": role, "content": content})
 
-        # Удаляем старые сообщения, если превышен лимит
-        if len(self._history[user_id]) > self.max_messages:
-            self._history[user_id] = self._history[user_id][-self.max_messages :]
+        # Запись в базу откладывается до фонового flush()
+        self._pending.append((user_id, role, content))
+        self._dirty.set()
 
-        # Сохраняем в файл после каждого добавления
-        self._save_to_file()
+        return history
 
-    def get_history(self, user_id: int) -> List[Dict[str, str]]:
+    async def get_history(self, user_id: int) -> Sequence[Dict[str, str]]:
         """
         Получить историю сообщений пользователя.
 
+        Если истории нет в памяти, она загружается из базы.
+        Возвращается внутреннее хранилище без копирования, его нельзя изменять.
+
         Args:
             user_id: ID пользователя
 
         Returns:
-            Список словарей с ключами 'role' и 'content'
+            Последовательность словарей с ключами 'role' и 'content'
         """
-        return self._history.get(user_id, []).copy()
+        if user_id in self._history:
+            self._history.move_to_end(user_id)
+            return self._history[user_id]
 
-    def clear_history(self, user_id: int) -> None:
+        messages = await self._load_user(user_id)
+        if not messages:
+            # Пустую историю не кэшируем, чтобы чтение не вытесняло
+            # из памяти активных пользователей
+            return ()
+        return self._remember(user_id, messages)
+
+    async def clear_history(self, user_id: int) -> None:
         """
         Очистить историю сообщений пользователя.
 
         Args:
             user_id: ID пользователя
         """
-        if user_id in self._history:
-            del self._history[user_id]
-            # Сохраняем в файл после очистки
-            self._save_to_file()
+        async with self._flush_lock:
+            self._history.pop(user_id, None)
+            self._pending = [r for r in self._pending if r[0] != user_id]
+            await asyncio.to_thread(self._delete_user, user_id)